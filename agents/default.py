@@ -1,9 +1,17 @@
 from __future__ import print_function
+import os
+import math
+import inspect
+import contextlib
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 from types import MethodType
 import models
-from utils.metric import accuracy, matthews, pearson_and_spearman, AverageMeter, Timer
+from dataloaders.wrapper import BertBatch
+from torch.utils.data.distributed import DistributedSampler
+from utils.metric import AccuracyMeter, MCCMeter, CorrMeter, AverageMeter, Timer
 from transformers.modeling_outputs import SequenceClassifierOutput
 from transformers import (
     WEIGHTS_NAME,
@@ -43,23 +51,56 @@ class NormalNN(nn.Module):
         '''
         :param agent_config (dict): lr=float,momentum=float,weight_decay=float,
                                     schedule=[int],  # The last number in the list is the end of epoch
+                                    warmup_steps=int  # Steps of linear lr warmup, warmup_ratio is used when it is 0
+                                    warmup_ratio=float  # Fraction of the steps used for linear lr warmup
                                     model_type=str,model_name=str,out_dim={task:dim},model_weights=str
                                     force_single_head=bool
                                     print_freq=int
                                     gpuid=[int]
+                                    amp_dtype=str  # 'fp32'|'fp16'|'bf16'
+                                    compile=bool
+                                    jit_eval=bool  # Run validation through a traced and frozen copy of the model
+                                    grad_accum=int  # Number of mini-batches accumulated per optimizer step
         '''
         super(NormalNN, self).__init__()
-        self.log = print if agent_config['print_freq'] > 0 else lambda \
+        self._log_enabled = agent_config['print_freq'] > 0
+        self.log = print if self._log_enabled else lambda \
             *args: None  # Use a void function to replace the print
         self.config = agent_config
         self.args = args
         # If out_dim is a dict, there is a list of tasks. The model will have a head for each task.
         self.multihead = True if len(self.config['out_dim'])>1 else False  # A convenience flag to indicate multi-head/task
+        self._task_to_id = {t: i for i, t in enumerate(sorted(self.config['out_dim']))}  # Head name -> integer id
+        if agent_config['gpuid'][0] < 0:
+            self.device = torch.device('cpu')
+        elif len(agent_config['gpuid']) > 1:  # One process per GPU, launched by torchrun
+            self.device = torch.device('cuda', agent_config['gpuid'][int(os.environ.get('LOCAL_RANK', 0))])
+        else:
+            self.device = torch.device('cuda', agent_config['gpuid'][0])
         self.model = self.create_model()
-        # if self.args.output_mode == 'classification':
-        #     self.criterion_fn = nn.CrossEntropyLoss()
-        # elif self.args.output_mode == 'regression':
-        #     self.criterion_fn = nn.MSELoss()
+        # Resolve how inputs are fed to the model once instead of on every batch
+        if isinstance(self.base_model(), (BertForSequenceClassification, AlbertForSequenceClassification)):
+            self._forward_impl = lambda x: self.model(**x)
+        else:
+            self._forward_impl = lambda x: self.model(x)
+        # Mixed precision: bf16 runs without loss scaling, fp16 needs the GradScaler
+        amp_dtype = agent_config.get('amp_dtype', 'fp32')
+        self.amp_enabled = amp_dtype in ['fp16', 'bf16'] and self.device.type == 'cuda'
+        self.amp_dtype = torch.bfloat16 if amp_dtype == 'bf16' else torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp_enabled and amp_dtype == 'fp16')
+        # The traced eval graph is not combined with torch.compile or autocast
+        self._jit_eval = agent_config.get('jit_eval', False) and not agent_config.get('compile', False) \
+            and not self.amp_enabled
+        self._eval_model = None  # Traced lazily by predict, reset whenever training changes the weights
+        self.accum_steps = agent_config.get('grad_accum', 1)
+        self._step_i = 0  # Mini-batches seen by update_model, the optimizer steps every accum_steps of them
+        self._total_batches = 0  # Mini-batches of the current learn_batch, the last one closes a partial window
+        # One (mean, per-sample) pair of loss modules per GLUE output mode, picked by learn_batch/validation
+        # The per-sample ones let the multi-head criterion sum each head's losses under its task mask
+        self._criterions = {'classification': (nn.CrossEntropyLoss().to(self.device),
+                                               nn.CrossEntropyLoss(reduction='none').to(self.device)),
+                            'regression': (nn.MSELoss().to(self.device),
+                                           nn.MSELoss(reduction='none').to(self.device))}
         if agent_config['gpuid'][0] >= 0:
             self.cuda()
             self.gpu = True
@@ -71,7 +112,7 @@ class NormalNN(nn.Module):
                                     # Set a interger here for the incremental class scenario
 
     def init_optimizer(self):
-        optimizer_arg = {'params':self.model.parameters(),
+        optimizer_arg = {'params':list(self.model.parameters()),  # A list so a failed construction can be retried
                          'lr':self.config['lr'],
                          'weight_decay':self.config['weight_decay']}
         if self.config['optimizer'] in ['SGD','RMSprop']:
@@ -82,9 +123,19 @@ class NormalNN(nn.Module):
             optimizer_arg['amsgrad'] = True
             self.config['optimizer'] = 'Adam'
 
-        self.optimizer = torch.optim.__dict__[self.config['optimizer']](**optimizer_arg)
-        self.scheduler = torch.optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=self.config['schedule'],
-                                                              gamma=0.1)
+        optimizer_class = torch.optim.__dict__[self.config['optimizer']]
+        self.optimizer = None
+        if self.gpu and self.config['optimizer'] in ['Adam', 'AdamW', 'SGD']:
+            # Update all parameters in one multi-tensor kernel. fused needs PyTorch>=2.0, foreach is the fallback
+            for multi_tensor_arg in ['fused', 'foreach']:
+                try:
+                    self.optimizer = optimizer_class(**dict(optimizer_arg, **{multi_tensor_arg: True}))
+                    break
+                except (TypeError, RuntimeError):
+                    pass
+        if self.optimizer is None:
+            self.optimizer = optimizer_class(**optimizer_arg)
+        self.scheduler = None  # Built in learn_batch, where the number of steps is known
 
     def create_model(self):
         cfg = self.config
@@ -119,84 +170,89 @@ class NormalNN(nn.Module):
         # Load pre-trained weights
         if cfg['model_weights'] is not None:
             print('=> Load model weights:', cfg['model_weights'])
-            model_state = torch.load(cfg['model_weights'],
-                                     map_location=lambda storage, loc: storage)  # Load to CPU.
+            # Stream the weights from disk straight to the device the model will live on
+            model = model.to(self.device)
+            if cfg['model_weights'].endswith('.safetensors'):
+                from safetensors.torch import load_file
+                model_state = load_file(cfg['model_weights'], device=str(self.device))
+            else:
+                model_state = None
+                if 'mmap' in inspect.signature(torch.load).parameters:  # PyTorch>=2.1
+                    try:
+                        model_state = torch.load(cfg['model_weights'], map_location=self.device, mmap=True)
+                    except RuntimeError as e:
+                        # Only checkpoints in the legacy (non-zipfile) format fall back, anything else is re-raised
+                        if 'mmap can only be used with files saved with' not in str(e):
+                            raise
+                if model_state is None:
+                    model_state = torch.load(cfg['model_weights'], map_location=self.device)
             model.load_state_dict(model_state)
             print('=> Load Done')
+        if cfg.get('compile', False):
+            # Keep the generated kernels across runs
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join('outputs', 'inductor_cache'))
+            # Compile the bare nn.Module; GLUE features are padded to max_seq_length so the shapes are static
+            model = torch.compile(model, mode='max-autotune', fullgraph=False, dynamic=False)
         return model
 
+    def base_model(self):
+        # The model without the DistributedDataParallel/torch.compile wrappers
+        model = self.model
+        if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+            model = model.module
+        return getattr(model, '_orig_mod', model)
+
     def forward(self, x):
-        if isinstance(self.model, BertForSequenceClassification):
-            #print('it is in default.py line 123')
-            #print(x)
-            return self.model.forward(**x)
-        elif isinstance(self.model, AlbertForSequenceClassification):
-            return self.model.forward(**x)
-        else:
-            return self.model.forward(x)
+        return self._forward_impl(x)
 
     def predict(self, inputs):
         self.model.eval()
-        out = self.forward(inputs)
-        for t in out.keys():
-            out[t] = out[t].detach()
-        return out
+        if self._jit_eval and isinstance(inputs, BertBatch):
+            if self._eval_model is None:
+                # Freezing folds the current weights into the graph as constants
+                with torch.no_grad():
+                    traced = torch.jit.trace(self.base_model(), example_kwarg_inputs=dict(inputs), strict=False)
+                self._eval_model = torch.jit.freeze(traced)
+            with torch.inference_mode():
+                return SequenceClassifierOutput(**self._eval_model(**inputs))
+        # inference_mode outputs carry no autograd history, so there is nothing to detach
+        with torch.inference_mode(), torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp_enabled):
+            return self.forward(inputs)
 
     def validation(self, val_name, dataloader):
         # This function doesn't distinguish tasks.
         batch_timer = Timer()
         output_mode = output_modes[val_name]
-        if val_name == 'cola':
-            mcc = AverageMeter()
-            self.criterion_fn = nn.CrossEntropyLoss().cuda()
-        elif output_mode == 'classification':
-            acc = AverageMeter()
-            self.criterion_fn = nn.CrossEntropyLoss().cuda()
-        elif output_mode == 'regression':
-            corr = AverageMeter()
-            self.criterion_fn = nn.MSELoss().cuda()
+        self.criterion_fn, self.sample_criterion_fn = self._criterions[output_mode]
+        self._regression = output_mode == 'regression'
+        meter_class, metric_name = select_metric(val_name, output_mode)
+        meter = meter_class()
         batch_timer.tic()
 
         orig_mode = self.training
         self.eval()
         for i, (input, target, task) in enumerate(dataloader):
 
-            if self.gpu:
-                with torch.no_grad():
-                    target = target.cuda()
-                    if isinstance(input, list):
-                        input = tuple(t.cuda() for t in input)
-                        input = {"input_ids": input[0], "attention_mask": input[1], "token_type_ids": (input[2]),  "labels": target}
-                        #input["token_type_ids"] = (input[2])  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-                    else:
-                        input = input.cuda()
+            if isinstance(input, list):  # Transformer samples from a loader without bert_collate
+                input = BertBatch(*input, target)
+            # Async H2D copies, the dataloader hands us pinned memory
+            if isinstance(input, BertBatch):  # Already assembled by bert_collate, the labels are the target
+                if self.gpu:
+                    input = input.to(self.device, non_blocking=True)
+                target = input.labels
+            elif self.gpu:
+                input = input.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
             output = self.predict(input)
 
             # Summarize the performance of all tasks, or 1 task, depends on dataloader.
             # Calculated by total number of data.
-            if val_name == 'cola':
-                mcc = accumulate_mcc(output, target, task, mcc)
-            elif output_mode == 'classification':
-                acc = accumulate_acc(output, target, task, acc)
-            elif output_mode == 'regression':
-                corr = accumulate_corr(output, target, task, corr)
+            meter = accumulate(output, target, task, meter)
 
         self.train(orig_mode)
-        if val_name == 'cola':
-            self.log(' * Val mcc {mcc.avg:.3f}, Total time {time:.2f}'
-                     .format(mcc=mcc, time=batch_timer.toc()))
-        elif self.args.output_mode == 'classification':
-            self.log(' * Val Acc {acc.avg:.3f}, Total time {time:.2f}'
-                  .format(acc=acc, time=batch_timer.toc()))
-        elif self.args.output_mode == 'regression':
-            self.log(' * Val corr {corr.avg:.3f}, Total time {time:.2f}'
-                     .format(corr=corr, time=batch_timer.toc()))
-        if val_name == 'cola':
-            return mcc.avg
-        elif self.args.output_mode == 'classification':
-            return acc.avg
-        elif self.args.output_mode == 'regression':
-            return corr.avg
+        self.log(' * Val {name} {meter.avg:.3f}, Total time {time:.2f}'
+                 .format(name=metric_name, meter=meter, time=batch_timer.toc()))
+        return meter.avg
 
     def criterion(self, preds, targets, tasks, **kwargs):
         # The inputs and targets could come from single task or a mix of tasks
@@ -204,13 +260,19 @@ class NormalNN(nn.Module):
         # The criterion will match the head and task to calculate the loss.
 
         if self.multihead:
+            # Sum the per-sample losses of each head under its task mask on the device, without syncing counts.
+            # Which heads are present is decided from the host-side task names, so absent heads keep grad=None
             loss = 0
+            present = set(tasks)
+            tids = torch.as_tensor([self._task_to_id[t] for t in tasks]).to(targets.device, non_blocking=True)
             for t,t_preds in preds.items():
-                inds = [i for i in range(len(tasks)) if tasks[i]==t]  # The index of inputs that matched specific task
-                if len(inds)>0:
-                    t_preds = t_preds[inds]
-                    t_target = targets[inds]
-                    loss += self.criterion_fn(t_preds, t_target) * len(inds)  # restore the loss from average
+                if t in present:
+                    mask = tids == self._task_to_id[t]  # The mask of inputs that matched specific task
+                    t_target = torch.where(mask, targets, torch.zeros_like(targets))  # Other tasks' labels may be out of range
+                    if self._regression:  # One output per sample, compared with float targets
+                        t_preds, t_target = t_preds.squeeze(-1), t_target.to(t_preds.dtype)
+                    t_loss = self.sample_criterion_fn(t_preds, t_target)
+                    loss += (t_loss * mask).sum()
             loss /= len(targets)  # Average the total loss by the mini-batch size
         else:
             if 'All' in preds:
@@ -223,11 +285,23 @@ class NormalNN(nn.Module):
         return loss
 
     def update_model(self, inputs, targets, tasks):
-        out = self.forward(inputs)
-        loss = self.criterion(out, targets, tasks)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        if self._step_i % self.accum_steps == 0:  # First mini-batch of an accumulation window
+            self.optimizer.zero_grad(set_to_none=True)  # Skip the per-parameter memset kernels
+        self._step_i += 1
+        do_step = self._step_i % self.accum_steps == 0 or self._step_i == self._total_batches
+        # DDP only needs to all-reduce the gradients of the mini-batch that completes the window
+        sync_ctx = self.model.no_sync() if not do_step and \
+            isinstance(self.model, torch.nn.parallel.DistributedDataParallel) else contextlib.nullcontext()
+        with sync_ctx:
+            with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp_enabled):
+                out = self.forward(inputs)
+                loss = self.criterion(out, targets, tasks)
+            self.scaler.scale(loss / self.accum_steps).backward()
+        if do_step:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            if self.scheduler is not None:
+                self.scheduler.step()
         return loss.detach(), out
 
     def learn_batch(self, train_name, train_loader, val_loader=None):
@@ -235,10 +309,18 @@ class NormalNN(nn.Module):
             self.log('Optimizer is reset!')
             self.init_optimizer()
         output_mode = output_modes[train_name]
-        if output_mode == 'classification':
-            self.criterion_fn = nn.CrossEntropyLoss().cuda()
-        elif output_mode == 'regression':
-            self.criterion_fn = nn.MSELoss().cuda()
+        self.criterion_fn, self.sample_criterion_fn = self._criterions[output_mode]
+        self._regression = output_mode == 'regression'
+        meter_class, metric_name = select_metric(train_name, output_mode)
+        print_freq, n_batches = self.config['print_freq'], len(train_loader)
+
+        # Linear warmup then linear decay, stepped after every optimizer step
+        self._step_i = 0  # Start a fresh accumulation window for the new task
+        self._total_batches = n_batches * self.config['schedule'][-1]
+        total_steps = max(math.ceil(self._total_batches / self.accum_steps), 1)
+        num_warmup_steps = self.config.get('warmup_steps', 0) or int(self.config.get('warmup_ratio', 0.1) * total_steps)
+        self.scheduler = get_linear_schedule_with_warmup(
+            self.optimizer, num_warmup_steps=num_warmup_steps, num_training_steps=total_steps)
 
         for epoch in range(self.config['schedule'][-1]):
             data_timer = Timer()
@@ -246,17 +328,14 @@ class NormalNN(nn.Module):
             batch_time = AverageMeter()
             data_time = AverageMeter()
             losses = AverageMeter()
-            if train_name == 'cola':
-                mcc = AverageMeter()
-            elif output_mode == 'classification':
-                acc = AverageMeter()
-            elif output_mode == 'regression':
-                corr = AverageMeter()
+            meter = meter_class()
 
             # Config the model and optimizer
             self.log('Epoch:{0}'.format(epoch))
             self.model.train()
-            self.scheduler.step(epoch)
+            self._eval_model = None  # The frozen eval graph holds the previous weights
+            if isinstance(train_loader.sampler, DistributedSampler):
+                train_loader.sampler.set_epoch(epoch)  # Reshuffle the shards every epoch
             for param_group in self.optimizer.param_groups:
                 self.log('LR:',param_group['lr'])
 
@@ -265,70 +344,41 @@ class NormalNN(nn.Module):
             batch_timer.tic()
             self.log('Itr\t\tTime\t\t  Data\t\t  Loss\t\tAcc')
             for i, (input, target, task) in enumerate(train_loader):
-                data_time.update(data_timer.toc())  # measure data loading time
-
-                if self.gpu:
-                    target = target.cuda()
-                    if isinstance(input, list):
-                        input = tuple(t.cuda() for t in input)
-                        input = {"input_ids": input[0], "attention_mask": input[1], "token_type_ids": (input[2]),  "labels": target}
-                        #input["token_type_ids"] = (input[2])  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
-                    else:
-                        input = input.cuda()
+                if self._log_enabled:
+                    data_time.update(data_timer.toc())  # measure data loading time
+
+                if isinstance(input, list):  # Transformer samples from a loader without bert_collate
+                    input = BertBatch(*input, target)
+                # Async H2D copies, the dataloader hands us pinned memory
+                if isinstance(input, BertBatch):  # Already assembled by bert_collate, the labels are the target
+                    if self.gpu:
+                        input = input.to(self.device, non_blocking=True)
+                    target = input.labels
+                elif self.gpu:
+                    input = input.to(self.device, non_blocking=True)
+                    target = target.to(self.device, non_blocking=True)
 
                 loss, output = self.update_model(input, target, task)
-                if isinstance(input, dict):
-                    sample = input['input_ids'].detach()
-                    losses.update(loss, sample.size(0))
-                else:
-                    input = input.detach()
-                    losses.update(loss, input.size(0))
-                target = target.detach()
-
-                # measure accuracy, mcc, corr, and record loss
-                if train_name == 'cola':
-                    mcc = accumulate_mcc(output, target, task, mcc)
-                elif output_mode == 'classification':
-                    acc = accumulate_acc(output, target, task, acc)
-                elif output_mode == 'regression':
-                    corr = accumulate_corr(output, target, task, corr)
-
-                batch_time.update(batch_timer.toc())  # measure elapsed time
-                data_timer.toc()
-
-                if train_name == 'cola':
-                    if ((self.config['print_freq']>0) and (i % self.config['print_freq'] == 0)) or (i+1)==len(train_loader):
-                        self.log('[{0}/{1}]\t'
-                              '{batch_time.val:.4f} ({batch_time.avg:.4f})\t'
-                              '{data_time.val:.4f} ({data_time.avg:.4f})\t'
-                              '{loss.val:.3f} ({loss.avg:.3f})\t'
-                              '{mcc.val:.2f} ({mcc.avg:.2f})'.format(
-                            i, len(train_loader), batch_time=batch_time,
-                            data_time=data_time, loss=losses, mcc=mcc))
-                elif output_mode == 'classification':
-                    if ((self.config['print_freq']>0) and (i % self.config['print_freq'] == 0)) or (i+1)==len(train_loader):
-                        self.log('[{0}/{1}]\t'
-                              '{batch_time.val:.4f} ({batch_time.avg:.4f})\t'
-                              '{data_time.val:.4f} ({data_time.avg:.4f})\t'
-                              '{loss.val:.3f} ({loss.avg:.3f})\t'
-                              '{acc.val:.2f} ({acc.avg:.2f})'.format(
-                            i, len(train_loader), batch_time=batch_time,
-                            data_time=data_time, loss=losses, acc=acc))
-                elif output_mode == 'regression':
-                    if ((self.config['print_freq']>0) and (i % self.config['print_freq'] == 0)) or (i+1)==len(train_loader):
+                # The meters and timers only feed the log, skip them when it is disabled
+                if self._log_enabled:
+                    # loss is already detached, so the meter sums it on the GPU without holding the graph
+                    losses.update(loss, target.size(0))
+
+                    # measure accuracy, mcc, corr, and record loss
+                    meter = accumulate(output, target, task, meter)
+
+                    batch_time.update(batch_timer.toc())  # measure elapsed time
+                    data_timer.toc()
+
+                    if (i % print_freq == 0) or (i+1)==n_batches:
                         self.log('[{0}/{1}]\t'
                               '{batch_time.val:.4f} ({batch_time.avg:.4f})\t'
                               '{data_time.val:.4f} ({data_time.avg:.4f})\t'
                               '{loss.val:.3f} ({loss.avg:.3f})\t'
-                              '{corr.val:.2f} ({corr.avg:.2f})'.format(
-                            i, len(train_loader), batch_time=batch_time,
-                            data_time=data_time, loss=losses, corr=corr))
-            if train_name == 'cola':
-                self.log(' * Train mcc {mcc.avg:.3f}'.format(mcc=mcc))
-            elif output_mode == 'classification':
-                self.log(' * Train Acc {acc.avg:.3f}'.format(acc=acc))
-            elif output_mode == 'regression':
-                self.log(' * Train corr {corr.avg:.3f}'.format(corr=corr))
+                              '{meter.val:.2f} ({meter.avg:.2f})'.format(
+                            i, n_batches, batch_time=batch_time,
+                            data_time=data_time, loss=losses, meter=meter))
+            self.log(' * Train {name} {meter.avg:.3f}'.format(name=metric_name, meter=meter))
 
             # Evaluate the performance of current task
             if val_loader != None:
@@ -350,75 +400,56 @@ class NormalNN(nn.Module):
         return sum(p.numel() for p in self.model.parameters())
 
     def save_model(self, filename):
-        model_state = self.model.state_dict()
-        if isinstance(self.model,torch.nn.DataParallel):
-            # Get rid of 'module' before the name of states
-            model_state = self.model.module.state_dict()
-        for key in model_state.keys():  # Always save it to cpu
-            model_state[key] = model_state[key].cpu()
+        if dist.is_initialized() and dist.get_rank() != 0:
+            return  # Every rank holds the same weights, only the first one writes them
+        # Get rid of 'module'/'_orig_mod' before the name of states
+        # Always save it to cpu. Queue all D2H copies and wait once instead of stalling per tensor
+        model_state = {k: v.detach().to('cpu', non_blocking=True) for k, v in self.base_model().state_dict().items()}
+        if self.gpu:
+            torch.cuda.synchronize()
         print('=> Saving model to:', filename)
         torch.save(model_state, filename + '.pth')
         print('=> Save Done')
 
     def cuda(self):
-        torch.cuda.set_device(self.config['gpuid'][0])
+        torch.cuda.set_device(self.device)
         self.model = self.model.cuda()
         # self.criterion_fn = self.criterion_fn.cuda()
         # Multi-GPU
         if len(self.config['gpuid']) > 1:
-            self.model = torch.nn.DataParallel(self.model, device_ids=self.config['gpuid'], output_device=self.config['gpuid'][0])
+            assert dist.is_initialized(), 'Multi-GPU needs torchrun and torch.distributed.init_process_group("nccl")'
+            # A batch rarely holds every task, so the heads of the absent ones get no gradient
+            self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=[self.device.index],
+                                                                   find_unused_parameters=self.multihead)
         return self
 
-def accumulate_acc(output, target, task, meter):
-    #print(output)
-    if isinstance(output, SequenceClassifierOutput):
-        tmp_eval_loss, logits = output[:2]
-        meter.update(accuracy(logits, target), len(target))
-    else:
-        if 'All' in output.keys(): # Single-headed model
-            meter.update(accuracy(output['All'], target), len(target))
-        else:  # outputs from multi-headed (multi-task) model
-            for t, t_out in output.items():
-                inds = [i for i in range(len(task)) if task[i] == t]  # The index of inputs that matched specific task
-                if len(inds) > 0:
-                    t_out = t_out[inds]
-                    t_target = target[inds]
-                    meter.update(accuracy(t_out, t_target), len(inds))
-
-    return meter
-
-def accumulate_mcc(output, target, task, meter):
-    #print(output)
-    if isinstance(output, SequenceClassifierOutput):
-        tmp_eval_loss, logits = output[:2]
-        meter.update(matthews(logits, target), len(target))
-    else:
-        if 'All' in output.keys(): # Single-headed model
-            meter.update(matthews(output['All'], target), len(target))
-        else:  # outputs from multi-headed (multi-task) model
-            for t, t_out in output.items():
-                inds = [i for i in range(len(task)) if task[i] == t]  # The index of inputs that matched specific task
-                if len(inds) > 0:
-                    t_out = t_out[inds]
-                    t_target = target[inds]
-                    meter.update(matthews(t_out, t_target), len(inds))
-
-    return meter
-
-def accumulate_corr(output, target, task, meter):
-    #print(output)
+def select_metric(task_name, output_mode):
+    # Pick the GLUE metric of a task once, so the loops don't branch on every batch
+    # The meters keep their running state on the device and only sync when they are read
+    if task_name == 'cola':
+        return MCCMeter, 'mcc'
+    elif output_mode == 'classification':
+        return AccuracyMeter, 'Acc'
+    elif output_mode == 'regression':
+        return CorrMeter, 'corr'
+
+def accumulate(output, target, task, meter):
+    # Feed the outputs of the matching head(s) to the meter, which holds the metric-specific state
     if isinstance(output, SequenceClassifierOutput):
         tmp_eval_loss, logits = output[:2]
-        meter.update(pearson_and_spearman(logits, target), len(target))
+        meter.update(logits, target)
     else:
         if 'All' in output.keys(): # Single-headed model
-            meter.update(pearson_and_spearman(output['All'], target), len(target))
+            meter.update(output['All'], target)
         else:  # outputs from multi-headed (multi-task) model
+            task_t = np.asarray(task)
             for t, t_out in output.items():
-                inds = [i for i in range(len(task)) if task[i] == t]  # The index of inputs that matched specific task
-                if len(inds) > 0:
-                    t_out = t_out[inds]
-                    t_target = target[inds]
-                    meter.update(pearson_and_spearman(t_out, t_target), len(inds))
+                inds = task_t == t  # The mask of inputs that matched specific task
+                n = int(inds.sum())
+                if n > 0:
+                    mask = torch.from_numpy(inds)
+                    t_out = t_out[mask]
+                    t_target = target[mask]
+                    meter.update(t_out, t_target)
 
     return meter
@@ -1,6 +1,7 @@
 import torch
 import random
 from .default import NormalNN
+from dataloaders.wrapper import BertBatch
 from transformers.modeling_outputs import SequenceClassifierOutput
 
 class L2(NormalNN):
@@ -109,14 +110,19 @@ class EWC(L2):
             self.log('Sample',self.n_fisher_sample,'for estimating the F matrix.')
             rand_ind = random.sample(list(range(len(dataloader.dataset))), n_sample)
             subdata = torch.utils.data.Subset(dataloader.dataset, rand_ind)
-            dataloader = torch.utils.data.DataLoader(subdata, shuffle=True, num_workers=2, batch_size=1)
+            dataloader = torch.utils.data.DataLoader(subdata, shuffle=True, num_workers=2, batch_size=1,
+                                                     collate_fn=dataloader.collate_fn)
 
         mode = self.training
         self.eval()
 
         # Accumulate the square of gradients
         for i, (input, target, task) in enumerate(dataloader):
-            if self.gpu:
+            if isinstance(input, BertBatch):  # Already assembled by bert_collate
+                if self.gpu:
+                    input = input.to(self.device)
+                target = input.labels
+            elif self.gpu:
                 target = target.cuda()
                 if isinstance(input, list):
                     input = tuple(t.cuda() for t in input)
@@ -218,6 +224,8 @@ class SI(L2):
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
+        if self.scheduler is not None:
+            self.scheduler.step()
 
         # 4. Accumulate the w
         for n, p in self.params.items():
@@ -310,7 +318,11 @@ class MAS(L2):
 
         # Accumulate the gradients of L2 loss on the outputs
         for i, (input, target, task) in enumerate(dataloader):
-            if self.gpu:
+            if isinstance(input, BertBatch):  # Already assembled by bert_collate
+                if self.gpu:
+                    input = input.to(self.device)
+                target = input.labels
+            elif self.gpu:
                 target = target.cuda()
                 if isinstance(input, list):
                     input = tuple(t.cuda() for t in input)
@@ -381,14 +393,19 @@ class LPC(L2):
             self.log('Sample', self.n_fisher_sample, 'for estimating the F matrix.')
             rand_ind = random.sample(list(range(len(dataloader.dataset))), n_sample)
             subdata = torch.utils.data.Subset(dataloader.dataset, rand_ind)
-            dataloader = torch.utils.data.DataLoader(subdata, shuffle=True, num_workers=2, batch_size=1)
+            dataloader = torch.utils.data.DataLoader(subdata, shuffle=True, num_workers=2, batch_size=1,
+                                                     collate_fn=dataloader.collate_fn)
 
         mode = self.training
         self.eval()
 
         # Accumulate the square of gradients
         for i, (input, target, task) in enumerate(dataloader):
-            if self.gpu:
+            if isinstance(input, BertBatch):  # Already assembled by bert_collate
+                if self.gpu:
+                    input = input.to(self.device)
+                target = input.labels
+            elif self.gpu:
                 target = target.cuda()
                 if isinstance(input, list):
                     input = tuple(t.cuda() for t in input)
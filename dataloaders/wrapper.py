@@ -1,6 +1,8 @@
 from os import path
+from dataclasses import dataclass
 import torch
 import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
 
 
 class CacheClassLabel(data.Dataset):
@@ -56,6 +58,60 @@ class AppendName(data.Dataset):
             return img, target, self.name
 
 
+@dataclass
+class BertBatch:
+    """
+    The keyword inputs of a Bert/Albert sequence classifier.
+    It supports the mapping protocol, so model(**batch) and batch['labels'] work like with a dict
+    """
+    __slots__ = ('input_ids', 'attention_mask', 'token_type_ids', 'labels')
+    input_ids: torch.Tensor
+    attention_mask: torch.Tensor
+    token_type_ids: torch.Tensor  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
+    labels: torch.Tensor
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __len__(self):
+        # The number of keys, like the dict this replaces (EWC/LPC scale the Fisher information by len(input))
+        return len(self.__slots__)
+
+    def to(self, device, non_blocking=False):
+        return BertBatch(*(getattr(self, k).to(device, non_blocking=non_blocking) for k in self.__slots__))
+
+    def pin_memory(self):
+        # Called by DataLoader(pin_memory=True) for custom batch types
+        return BertBatch(*(getattr(self, k).pin_memory() for k in self.__slots__))
+
+
+# Let torch.compile/pytree treat BertBatch as a flat container of tensors
+try:
+    from torch.utils._pytree import register_pytree_node
+except ImportError:
+    try:
+        from torch.utils._pytree import _register_pytree_node as register_pytree_node
+    except ImportError:  # PyTorch without pytree support
+        register_pytree_node = None
+if register_pytree_node is not None:
+    register_pytree_node(BertBatch,
+                         lambda batch: ([getattr(batch, k) for k in BertBatch.__slots__], None),
+                         lambda values, context: BertBatch(*values))
+
+
+def bert_collate(batch):
+    """
+    A collate_fn for AppendName(is_transformer=True) samples that returns the model's keyword inputs as a BertBatch,
+    so they are assembled by the dataloader workers instead of the training loop.
+    The target is only carried as BertBatch.labels, the second item is None so it is not pinned twice
+    """
+    input, target, task = default_collate(batch)
+    return BertBatch(input[0], input[1], input[2], target), None, task
+
+
 class Subclass(data.Dataset):
     """
     A dataset wrapper that return the task name and remove the offset of labels (Let the labels start from 0)
@@ -7,6 +7,7 @@ from random import shuffle
 from collections import OrderedDict
 import dataloaders.base
 from dataloaders.datasetGen import SplitGen, PermutedGen
+from dataloaders.wrapper import bert_collate
 import agents
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
@@ -55,6 +56,16 @@ def run(args):
     if not os.path.exists('outputs'):
         os.mkdir('outputs')
 
+    # Multi-GPU runs one process per GPU (launched by torchrun), synchronized with NCCL
+    distributed = len(args.gpuid) > 1
+    if distributed:
+        if 'LOCAL_RANK' not in os.environ:
+            raise RuntimeError('More than one --gpuid needs one process per GPU, launch with: '
+                               'torchrun --nproc_per_node={} {} ...'.format(len(args.gpuid), sys.argv[0]))
+        args.local_rank = int(os.environ['LOCAL_RANK'])
+        if not torch.distributed.is_initialized():
+            torch.distributed.init_process_group('nccl')
+
     config_class, model_class, tokenizer_class = MODEL_CLASSES[args.sub_model_type]
 
     tokenizer = tokenizer_class.from_pretrained(
@@ -86,12 +97,15 @@ def run(args):
 
     # Prepare the Agent (model)
     agent_config = {'lr': args.lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay,'schedule': args.schedule,
+                    'warmup_steps': args.warmup_steps, 'warmup_ratio': args.warmup_ratio,
                     'model_type':args.model_type, 'model_name': args.model_name_or_path, 'model_weights':args.model_weights,
                     'out_dim':{'All':args.force_out_dim} if args.force_out_dim>0 else task_output_space,
                     'optimizer':args.optimizer,
                     'print_freq':args.print_freq, 'gpuid': args.gpuid,
                     'reg_coef':args.reg_coef, 'task_name': args.task_name,
-                    'cache_dir': args.cache_dir, 'sub_model_type': args.sub_model_type}
+                    'cache_dir': args.cache_dir, 'sub_model_type': args.sub_model_type,
+                    'amp_dtype': args.amp_dtype, 'compile': args.compile, 'jit_eval': args.jit_eval,
+                    'grad_accum': args.grad_accum}
 
     agent = agents.__dict__[args.agent_type].__dict__[args.agent_name](agent_config)
     print(agent.model)
@@ -110,14 +124,18 @@ def run(args):
 
         train_dataset_all = torch.utils.data.ConcatDataset(train_dataset_splits.values())
         val_dataset_all = torch.utils.data.ConcatDataset(val_dataset_splits.values())
-        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_sampler = DistributedSampler(train_dataset_all) if distributed else RandomSampler(train_dataset_all)
         train_loader = torch.utils.data.DataLoader(train_dataset_all,sampler=train_sampler,
-                                                   batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+                                                   batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                                                   collate_fn=bert_collate,
+                                                   pin_memory=True, persistent_workers=args.workers > 0)
         #args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
         args.train_batch_size = args.per_gpu_train_batch_size
 
         val_loader = torch.utils.data.DataLoader(val_dataset_all,
-                                                 batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+                                                 batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                                                 collate_fn=bert_collate,
+                                                 pin_memory=True, persistent_workers=args.workers > 0)
 
         agent.learn_batch(train_loader, val_loader)
 
@@ -129,10 +147,16 @@ def run(args):
         for i in range(len(task_names)):
             train_name = task_names[i]
             print('======================',train_name,'=======================')
-            train_loader = torch.utils.data.DataLoader(train_dataset_splits[train_name],
-                                                        batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
+            train_sampler = DistributedSampler(train_dataset_splits[train_name]) if distributed else None
+            train_loader = torch.utils.data.DataLoader(train_dataset_splits[train_name], sampler=train_sampler,
+                                                        batch_size=args.batch_size, shuffle=not distributed,
+                                                        num_workers=args.workers,
+                                                        collate_fn=bert_collate,
+                                                        pin_memory=True, persistent_workers=args.workers > 0)
             val_loader = torch.utils.data.DataLoader(val_dataset_splits[train_name],
-                                                      batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+                                                      batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                                                      collate_fn=bert_collate,
+                                                      pin_memory=True, persistent_workers=args.workers > 0)
 
             if args.incremental_class:
                 agent.add_valid_output_dim(task_output_space[train_name])
@@ -148,7 +172,9 @@ def run(args):
                 val_data = val_dataset_splits[val_name] if not args.eval_on_train_set else train_dataset_splits[val_name]
                 val_loader = torch.utils.data.DataLoader(val_data,
                                                          batch_size=args.batch_size, shuffle=False,
-                                                         num_workers=args.workers)
+                                                         num_workers=args.workers,
+                                                         collate_fn=bert_collate,
+                                                         pin_memory=True, persistent_workers=args.workers > 0)
                 acc_table[val_name][train_name] = agent.validation(val_loader)
 
     return acc_table, task_names
@@ -183,7 +209,10 @@ def get_args(argv):
     parser.add_argument(
         "--per_gpu_eval_batch_size", default=8, type=int, help="Batch size per GPU/CPU for evaluation.",
     )
-    parser.add_argument("--warmup_steps", default=0, type=int, help="Linear warmup over warmup_steps.")
+    parser.add_argument("--warmup_steps", default=0, type=int,
+                        help="Linear lr warmup over x optimizer steps of each task. Overrides --warmup_ratio when > 0")
+    parser.add_argument("--warmup_ratio", default=0.1, type=float,
+                        help="Fraction of the optimizer steps of each task used for the linear lr warmup")
     parser.add_argument(
         "--max_steps",
         default=-1,
@@ -212,7 +241,8 @@ def get_args(argv):
         "--do_lower_case", action="store_true", help="Set this flag if you are using an uncased model.",
     )
     parser.add_argument('--gpuid', nargs="+", type=int, default=[0],
-                        help="The list of gpuid, ex:--gpuid 3 1. Negative value means cpu-only")
+                        help="The list of gpuid, ex:--gpuid 3 1. Negative value means cpu-only. "
+                             "More than one gpuid needs a torchrun launch with one process per GPU")
     parser.add_argument('--model_type', type=str, default='mlp', help="The type (mlp|lenet|vgg|resnet) of backbone network")
     parser.add_argument('--sub_model_type', type=str, default='bert',
                         help="The type (mlp|lenet|vgg|resnet|bert) of backbone network")
@@ -234,8 +264,16 @@ def get_args(argv):
                         help="Randomize the classes in splits")
     parser.add_argument('--rand_split_order', dest='rand_split_order', default=False, action='store_true',
                         help="Randomize the order of splits")
+    parser.add_argument('--amp_dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help="Precision of the forward/backward pass. fp16 uses a GradScaler, bf16 does not need one")
+    parser.add_argument('--compile', dest='compile', default=False, action='store_true',
+                        help="Wrap the model with torch.compile")
+    parser.add_argument('--jit_eval', dest='jit_eval', default=False, action='store_true',
+                        help="Validate with a torch.jit traced and frozen model. Ignored with --compile or --amp_dtype")
     parser.add_argument('--workers', type=int, default=3, help="#Thread for dataloader")
     parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--grad_accum', type=int, default=1,
+                        help="Accumulate the gradients of x mini-batches before each optimizer step")
     parser.add_argument('--lr', type=float, default=0.01, help="Learning rate")
     parser.add_argument('--momentum', type=float, default=0)
     parser.add_argument("--tokenizer_name",default="",type=str,help="Pretrained tokenizer name or path if not the same as model_name",)
@@ -255,7 +293,8 @@ def get_args(argv):
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
     parser.add_argument('--weight_decay', type=float, default=0)
     parser.add_argument('--schedule', nargs="+", type=int, default=[2],
-                        help="The list of epoch numbers to reduce learning rate by factor of 0.1. Last number is the end epoch")
+                        help="Only the last number is used: the end epoch. The learning rate warms up linearly from 0 "
+                             "(see --warmup_steps/--warmup_ratio), then decays linearly to 0")
     parser.add_argument('--print_freq', type=float, default=100, help="Print the log at every x iteration")
     parser.add_argument('--model_weights', type=str, default=None,
                         help="The path to the file for the model weights (*.pth).")
@@ -1,7 +1,6 @@
 import time
 import torch
 from scipy.stats import pearsonr, spearmanr
-from sklearn.metrics import matthews_corrcoef
 
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
@@ -23,36 +22,15 @@ def accuracy(output, target, topk=(1,)):
         else:
             return res
 
-def matthews(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
-    with torch.no_grad():
-        maxk = max(topk)
-
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        mcc = 100 * matthews_corrcoef(target.detach().cpu().numpy(), pred[0].detach().cpu().numpy())
-
-        return mcc
-
-def pearson_and_spearman(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
-    with torch.no_grad():
-        output = output.t()[0]
-        pearson_corr = pearsonr(output.detach().cpu().numpy(), target.detach().cpu().numpy())[0]
-        spearman_corr = spearmanr(output.detach().cpu().numpy(), target.detach().cpu().numpy())[0]
-        corr = 100 * (pearson_corr + spearman_corr) / 2
-        return corr
-
-
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value.
+    A tensor val keeps the running sum on its device, the host only syncs when avg is read"""
 
     def __init__(self):
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -60,7 +38,112 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = float(self.sum) / self.count
+
+    @property
+    def avg(self):
+        return float(self.sum) / self.count if self.count else 0
+
+
+class AccuracyMeter(object):
+    """Counts correct top-1 predictions on the device. Nothing is synced to the host until val/avg is read"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.correct = 0
+        self.count = 0
+        self.batch_correct = 0
+        self.batch_count = 0
+
+    def update(self, output, target):
+        with torch.no_grad():
+            self.batch_correct = (output.argmax(1) == target).sum()
+        self.batch_count = target.size(0)
+        self.correct = self.correct + self.batch_correct
+        self.count += self.batch_count
+
+    @property
+    def val(self):
+        return float(self.batch_correct) * 100.0 / self.batch_count if self.batch_count else 0.
+
+    @property
+    def avg(self):
+        return float(self.correct) * 100.0 / self.count if self.count else 0.
+
+
+class MCCMeter(object):
+    """Accumulates the confusion matrix on the device and computes the Matthews correlation when read"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.confusion = 0
+        self.batch_confusion = None
+
+    def update(self, output, target):
+        with torch.no_grad():
+            n_class = output.size(1)
+            pred = output.argmax(1)
+            self.batch_confusion = torch.bincount(target * n_class + pred,
+                                                  minlength=n_class * n_class).view(n_class, n_class)
+        self.confusion = self.confusion + self.batch_confusion
+
+    @staticmethod
+    def mcc(confusion):
+        # Same multi-class formula as sklearn.metrics.matthews_corrcoef
+        if confusion is None or isinstance(confusion, int):
+            return 0.
+        confusion = confusion.double()
+        t_sum = confusion.sum(1)
+        p_sum = confusion.sum(0)
+        n_correct = confusion.trace()
+        n_samples = confusion.sum()
+        cov_ytyp = n_correct * n_samples - (t_sum * p_sum).sum()
+        cov_ypyp = n_samples ** 2 - (p_sum * p_sum).sum()
+        cov_ytyt = n_samples ** 2 - (t_sum * t_sum).sum()
+        denominator = float(cov_ytyt * cov_ypyp)
+        if denominator == 0:
+            return 0.
+        return 100 * float(cov_ytyp) / denominator ** 0.5
+
+    @property
+    def val(self):
+        return self.mcc(self.batch_confusion)
+
+    @property
+    def avg(self):
+        return self.mcc(self.confusion)
+
+
+class CorrMeter(object):
+    """Keeps the predictions and targets on the device and computes the pearson/spearman average when read"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.outputs = []
+        self.targets = []
+
+    def update(self, output, target):
+        self.outputs.append(output.detach()[:, 0].float())
+        self.targets.append(target.detach().float())
+
+    @staticmethod
+    def corr(output, target):
+        output = output.cpu().numpy()
+        target = target.cpu().numpy()
+        return 100 * (pearsonr(output, target)[0] + spearmanr(output, target)[0]) / 2
+
+    @property
+    def val(self):
+        return self.corr(self.outputs[-1], self.targets[-1]) if self.outputs else 0.
+
+    @property
+    def avg(self):
+        return self.corr(torch.cat(self.outputs), torch.cat(self.targets)) if self.outputs else 0.
 
 
 class Timer(object):